@@ -1,18 +1,40 @@
 # controller/main.py
+import asyncio
+import gzip
+import hashlib
 import os
+import threading
 import time
-from fastapi import FastAPI, HTTPException, Query
-from fastapi.responses import HTMLResponse
-from kubernetes import client, config
+from fastapi import FastAPI, HTTPException, Query, Request
+from fastapi.responses import HTMLResponse, ORJSONResponse, Response
+from kubernetes import client, config, watch
+from kubernetes.client.exceptions import ApiException
+from slowapi import Limiter, _rate_limit_exceeded_handler
+from slowapi.errors import RateLimitExceeded
+from slowapi.middleware import SlowAPIMiddleware
+from slowapi.util import get_remote_address
 
 # -------------------------------------------------------------------
 # Config
 # -------------------------------------------------------------------
 NAMESPACE = os.getenv("NAMESPACE", "eth-devnet")
-DEPLOYMENT = os.getenv("DEPLOYMENT", "loadgen")
-CONTAINER = os.getenv("CONTAINER", "loadgen")
+# ConfigMap the loadgen mounts and hot-reloads (one key per tunable env var)
+CONFIGMAP = os.getenv("CONFIGMAP", "loadgen-config")
+# Full relist interval for the ConfigMap informer (seconds)
+RESYNC_PERIOD = float(os.getenv("RESYNC_PERIOD", str(12 * 3600)))
 
-app = FastAPI(title="Loadgen Controller")
+# Per-client-IP rate limits (slowapi syntax) and cap on concurrent ConfigMap PATCHes
+RATE_LIMIT_DEFAULT = os.getenv("RATE_LIMIT_DEFAULT", "60/minute")
+RATE_LIMIT_STATE = os.getenv("RATE_LIMIT_STATE", "30/minute")
+RATE_LIMIT_SET = os.getenv("RATE_LIMIT_SET", "5/minute")
+MAX_INFLIGHT_PATCHES = int(os.getenv("MAX_INFLIGHT_PATCHES", "8"))
+
+app = FastAPI(title="Loadgen Controller", default_response_class=ORJSONResponse)
+
+limiter = Limiter(key_func=get_remote_address, default_limits=[RATE_LIMIT_DEFAULT])
+app.state.limiter = limiter
+app.add_exception_handler(RateLimitExceeded, _rate_limit_exceeded_handler)
+app.add_middleware(SlowAPIMiddleware)
 
 # Try in-cluster, fall back to local kubeconfig for dev
 try:
@@ -20,35 +42,116 @@ try:
 except Exception:
     config.load_kube_config()
 
-apps = client.AppsV1Api()
+core = client.CoreV1Api()
+
+
+# -------------------------------------------------------------------
+# ConfigMap informer (list + watch into a local cache)
+# -------------------------------------------------------------------
+_cache: dict = {}
+_cache_lock = threading.Lock()
+
+
+def _cached():
+    with _cache_lock:
+        return _cache.get("configmap")
+
+
+def _store(cm):
+    with _cache_lock:
+        if cm is None:
+            _cache.pop("configmap", None)
+        else:
+            _cache["configmap"] = cm
+
+
+def _relist():
+    cms = core.list_namespaced_config_map(
+        namespace=NAMESPACE, field_selector=f"metadata.name={CONFIGMAP}"
+    )
+    _store(cms.items[0] if cms.items else None)
+    return cms.metadata.resource_version
+
+
+def _informer():
+    rv = None
+    last_sync = 0.0
+    while True:
+        try:
+            if rv is None or time.monotonic() - last_sync >= RESYNC_PERIOD:
+                rv = _relist()
+                last_sync = time.monotonic()
+            w = watch.Watch()
+            for ev in w.stream(
+                core.list_namespaced_config_map,
+                namespace=NAMESPACE,
+                field_selector=f"metadata.name={CONFIGMAP}",
+                resource_version=rv,
+                timeout_seconds=600,
+            ):
+                if ev["type"] not in ("ADDED", "MODIFIED", "DELETED"):
+                    continue
+                obj = ev["object"]
+                _store(None if ev["type"] == "DELETED" else obj)
+                rv = obj.metadata.resource_version
+        except Exception as e:
+            rv = None
+            if isinstance(e, ApiException) and e.status == 410:
+                # resourceVersion too old: relist straight away
+                continue
+            print(f"[controller] informer error: {e}", flush=True)
+            time.sleep(5)
+
+
+@app.on_event("startup")
+def start_informer():
+    threading.Thread(target=_informer, name="configmap-informer", daemon=True).start()
 
 
 # -------------------------------------------------------------------
 # K8s helpers
 # -------------------------------------------------------------------
-def get_deploy():
-    return apps.read_namespaced_deployment(DEPLOYMENT, NAMESPACE)
+def get_config():
+    # Served from the informer cache; only hit the apiserver before the first sync
+    cm = _cached()
+    if cm is not None:
+        return cm
+    return core.read_namespaced_config_map(CONFIGMAP, NAMESPACE)
+
+
+_fetch_lock = asyncio.Lock()
+
+
+async def aget_config():
+    """
+    Async get_config(): a cache hit never leaves the event loop, and cold-cache
+    reads are single-flighted so a burst of UI polls costs one GET.
+    """
+    cm = _cached()
+    if cm is not None:
+        return cm
+    async with _fetch_lock:
+        cm = _cached()
+        if cm is None:
+            cm = await asyncio.to_thread(core.read_namespaced_config_map, CONFIGMAP, NAMESPACE)
+            # don't clobber a newer object the informer may have stored meanwhile
+            with _cache_lock:
+                cm = _cache.setdefault("configmap", cm)
+    return cm
 
 
-def _env_list(container):
-    return [{"name": e.name, "value": e.value} for e in (container.env or [])]
+_patch_sem = asyncio.Semaphore(MAX_INFLIGHT_PATCHES)
 
 
-def _set_env(env_list, name, value):
-    # upsert string value
-    value = "" if value is None else str(value)
-    for e in env_list:
-        if e["name"] == name:
-            e["value"] = value
-            return
-    env_list.append({"name": name, "value": value})
+async def apatch_env(tps: int, conc: int, rps_block: float, rps_bal: float, rps_call: float):
+    # bound in-flight PATCHes so a burst of clicks can't pile onto the apiserver
+    async with _patch_sem:
+        await asyncio.to_thread(patch_env_simple, tps, conc, rps_block, rps_bal, rps_call)
 
 
-def read_env():
-    dep = get_deploy()
-    containers = dep.spec.template.spec.containers
-    target = next((c for c in containers if c.name == CONTAINER), containers[0])
-    env = {e["name"]: e["value"] for e in _env_list(target)}
+def read_env(cm=None):
+    cm = cm if cm is not None else get_config()
+    env = cm.data or {}
     # Provide reasonable defaults if missing
     return {
         "tps": int(float(env.get("TPS", "80"))),
@@ -60,30 +163,25 @@ def read_env():
 
 
 def patch_env_simple(tps: int, conc: int, rps_block: float, rps_bal: float, rps_call: float):
-    dep = get_deploy()
-    containers = dep.spec.template.spec.containers
-    target = next((c for c in containers if c.name == CONTAINER), containers[0])
-
-    env_list = _env_list(target)
-    _set_env(env_list, "TPS", tps)
-    _set_env(env_list, "CONCURRENCY", conc)
-    _set_env(env_list, "RPS_BLOCK", rps_block)
-    _set_env(env_list, "RPS_BAL", rps_bal)
-    _set_env(env_list, "RPS_CALL", rps_call)
-
-    # bump an annotation to force rollout
-    anns = dep.spec.template.metadata.annotations or {}
-    anns["loadgen-controller/lastUpdate"] = str(time.time())
-
-    body = {
-        "spec": {
-            "template": {
-                "metadata": {"annotations": anns},
-                "spec": {"containers": [{"name": CONTAINER, "env": env_list}]},
-            }
-        }
+    """
+    Merge-patch all five tunables into the ConfigMap. They are always sent, not
+    just the ones that differ from the cache: a diff against a cached object can
+    drop a value another request (or an outside edit) changed meanwhile. The
+    loadgen watches the mounted ConfigMap and applies changes in place, so no
+    rollout is triggered.
+    """
+    data = {
+        "TPS": str(tps),
+        "CONCURRENCY": str(conc),
+        "RPS_BLOCK": str(rps_block),
+        "RPS_BAL": str(rps_bal),
+        "RPS_CALL": str(rps_call),
     }
-    apps.patch_namespaced_deployment(name=DEPLOYMENT, namespace=NAMESPACE, body=body)
+    updated = core.patch_namespaced_config_map(
+        name=CONFIGMAP, namespace=NAMESPACE, body={"data": data}
+    )
+    # write through so the next read reflects the patch before the watch event lands
+    _store(updated)
 
 
 # -------------------------------------------------------------------
@@ -93,12 +191,13 @@ def compute_mix(total_tps: float, preset: str):
     """
     Split a TOTAL rate across 5 logical methods:
       - send (eth_sendTransaction) -> TPS (write)
-      - tip  (eth_maxPriorityFeePerGas) -> implicitly ≈ TPS (handled in loadgen.py)
+      - tip  (eth_maxPriorityFeePerGas) -> not part of the mix; loadgen.py caches it
+        and refreshes it at most once per TIP_TTL (1s by default)
       - reads: block/bal/call -> env RPS_BLOCK/RPS_BAL/RPS_CALL
 
     Presets:
       - "even"  : 20% each  => per = total/5
-      - "write" : 35% send, 10% each read (tip stays ≈ TPS implicitly)
+      - "write" : 35% send, 10% each read
     Returns: dict with tps, rps_block, rps_bal, rps_call
     """
     t = max(float(total_tps), 0.0)
@@ -115,15 +214,18 @@ def compute_mix(total_tps: float, preset: str):
 # API
 # -------------------------------------------------------------------
 @app.get("/api/state")
-def api_state():
+@limiter.limit(RATE_LIMIT_STATE)
+async def api_state(request: Request):
     try:
-        return read_env()
+        return read_env(await aget_config())
     except Exception as e:
         raise HTTPException(500, f"read failed: {e}")
 
 
 @app.post("/api/set")
-def api_set(
+@limiter.limit(RATE_LIMIT_SET)
+async def api_set(
+    request: Request,
     tps: int = Query(..., ge=0, le=100000),
     concurrency: int = Query(..., ge=1, le=100000),
     rps_block: float = Query(0.0, ge=0, le=5000),
@@ -131,37 +233,37 @@ def api_set(
     rps_call: float = Query(0.0, ge=0, le=5000),
 ):
     try:
-        patch_env_simple(tps, concurrency, rps_block, rps_bal, rps_call)
+        await apatch_env(tps, concurrency, rps_block, rps_bal, rps_call)
         return {"ok": True}
     except Exception as e:
         raise HTTPException(500, f"patch failed: {e}")
 
 
 @app.post("/api/set_mix")
-def api_set_mix(
+@limiter.limit(RATE_LIMIT_SET)
+async def api_set_mix(
+    request: Request,
     total_tps: float = Query(..., ge=0, le=100000),
     preset: str = Query("write", regex="^(write|even)$"),
     concurrency: int = Query(None, ge=1, le=100000),
 ):
     """
     Accept TOTAL TPS + preset, compute per-method split server-side,
-    and patch the Deployment envs (TPS, CONCURRENCY, RPS_BLOCK/BAL/CALL).
+    and patch the loadgen ConfigMap (TPS, CONCURRENCY, RPS_BLOCK/BAL/CALL).
     """
     try:
-        cur = read_env()
-        conc = concurrency if concurrency is not None else cur["concurrency"]
+        cm = await aget_config()
+        conc = concurrency if concurrency is not None else read_env(cm)["concurrency"]
         mix = compute_mix(total_tps, preset)
-        patch_env_simple(
+        await apatch_env(
             int(mix["tps"]), int(conc), mix["rps_block"], mix["rps_bal"], mix["rps_call"]
         )
-        # Note: tip RPS ~= TPS implicitly, since loadgen calls eth_maxPriorityFeePerGas inside send_tx
         return {
             "ok": True,
             "applied": {
                 "preset": preset,
                 "total_tps": total_tps,
                 "TPS(send)": int(mix["tps"]),
-                "RPS(tip≈eth_maxPriorityFeePerGas)": int(mix["tps"]),
                 "RPS_BLOCK": mix["rps_block"],
                 "RPS_BAL": mix["rps_bal"],
                 "RPS_CALL": mix["rps_call"],
@@ -288,6 +390,39 @@ window.addEventListener('DOMContentLoaded', loadState);
 """
 
 
+# Encoded/compressed once at import; the page is static
+_HTML_BYTES = INDEX_HTML.encode()
+_HTML_GZ = gzip.compress(_HTML_BYTES, 9)
+# weak: the same tag covers both the gzip and identity encodings
+_HTML_ETAG = f'W/"{hashlib.md5(_HTML_BYTES).hexdigest()}"'
+_HTML_HEADERS = {
+    "ETag": _HTML_ETAG,
+    "Cache-Control": "public, max-age=300",
+    "Vary": "Accept-Encoding",
+}
+
+
+def _accepts_gzip(header: str) -> bool:
+    """True if Accept-Encoding allows gzip; an explicit gzip entry wins over `*`."""
+    q = {}
+    for part in header.lower().split(","):
+        coding, _, params = part.partition(";")
+        weight = 1.0
+        for param in params.split(";"):
+            key, _, val = param.strip().partition("=")
+            if key == "q":
+                try:
+                    weight = float(val)
+                except ValueError:
+                    weight = 0.0
+        q[coding.strip()] = weight
+    return q.get("gzip", q.get("*", 0.0)) > 0
+
+
 @app.get("/", response_class=HTMLResponse)
-def index():
-    return INDEX_HTML
+async def index(request: Request):
+    if _HTML_ETAG in request.headers.get("if-none-match", ""):
+        return Response(status_code=304, headers=_HTML_HEADERS)
+    if _accepts_gzip(request.headers.get("accept-encoding", "")):
+        return HTMLResponse(_HTML_GZ, headers={**_HTML_HEADERS, "Content-Encoding": "gzip"})
+    return HTMLResponse(_HTML_BYTES, headers=_HTML_HEADERS)
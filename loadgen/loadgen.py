@@ -3,25 +3,45 @@ import os
 import time
 import asyncio
 import contextlib
+import itertools
+import math
 import httpx
+import orjson
+import uvloop
+import watchfiles
+import websockets
 from prometheus_client import start_http_server, Counter, Gauge, Histogram
 
 RPC_URL = os.getenv("RPC_URL", "http://geth-devnet:8545")
+WS_URL = os.getenv("WS_URL", "ws://geth-devnet:8546")
 TPS = float(os.getenv("TPS", "10"))
 CONCURRENCY = int(os.getenv("CONCURRENCY", "50"))
 TO_ADDR = os.getenv("TO_ADDR", "0x62358b29b9e3e70ff51D88766e41a339D3e8FFff")
 VALUE_ETH = float(os.getenv("VALUE_ETH", "0.0001"))
 SAMPLE_WINDOW = float(os.getenv("SAMPLE_WINDOW", "5.0"))
+# How long a fetched eth_maxPriorityFeePerGas is reused; it changes at most once per block
+TIP_TTL = float(os.getenv("TIP_TTL", "1.0"))
 
 # Per-method read RPS (0 disables)
 RPS_BLOCK = float(os.getenv("RPS_BLOCK", "0"))  # eth_blockNumber
 RPS_BAL = float(os.getenv("RPS_BAL", "0"))  # eth_getBalance
 RPS_CALL = float(os.getenv("RPS_CALL", "0"))  # eth_call
 
+# Mounted ConfigMap with one file per tunable; overrides the env values above and
+# is re-read whenever it changes, so tuning doesn't need a pod restart
+CONFIG_DIR = os.getenv("CONFIG_DIR", "/etc/loadgen")
+TUNABLES = {
+    "TPS": float,
+    "CONCURRENCY": int,
+    "RPS_BLOCK": float,
+    "RPS_BAL": float,
+    "RPS_CALL": float,
+}
+
 print(
-    f"[loadgen] boot: RPC_URL={RPC_URL} TPS={TPS} CONCURRENCY={CONCURRENCY} "
-    f"TO={TO_ADDR} VALUE_ETH={VALUE_ETH} SAMPLE_WINDOW={SAMPLE_WINDOW} "
-    f"RPS_BLOCK={RPS_BLOCK} RPS_BAL={RPS_BAL} RPS_CALL={RPS_CALL}",
+    f"[loadgen] boot: RPC_URL={RPC_URL} WS_URL={WS_URL} TPS={TPS} CONCURRENCY={CONCURRENCY} "
+    f"TO={TO_ADDR} VALUE_ETH={VALUE_ETH} SAMPLE_WINDOW={SAMPLE_WINDOW} TIP_TTL={TIP_TTL} "
+    f"RPS_BLOCK={RPS_BLOCK} RPS_BAL={RPS_BAL} RPS_CALL={RPS_CALL} CONFIG_DIR={CONFIG_DIR}",
     flush=True,
 )
 
@@ -42,48 +62,160 @@ MGAS_S = Gauge("loadgen_mgas_per_s", "MegaGas per second (derived)")
 FAIL_RT = Gauge("loadgen_failure_rate", "Failure rate (0..1) over window")
 
 
+class _Children(dict):
+    """method -> bound child of a ["method"]-labelled metric; binds unknown methods once."""
+
+    def __init__(self, metric, methods):
+        super().__init__((m, metric.labels(m)) for m in methods)
+        self.metric = metric
+
+    def __missing__(self, method):
+        child = self[method] = self.metric.labels(method)
+        return child
+
+
+# Every method the loadgen sends; binding them up front also warms up the labelled
+# series so short-window rates aren't empty
+METHODS = (
+    "eth_sendTransaction",
+    "eth_maxPriorityFeePerGas",
+    "eth_blockNumber",
+    "eth_getBalance",
+    "eth_call",
+    "eth_accounts",
+    "eth_getBlockByHash",
+)
+_REQ = _Children(RPC_REQ, METHODS)
+_LAT = _Children(RPC_LAT, METHODS)
+
+
+class Stats:
+    """Plain tx outcome counters for the sampler (the Prometheus ones are for /metrics)."""
+
+    __slots__ = ("ok", "err")
+
+    def __init__(self):
+        self.ok = 0
+        self.err = 0
+
+
+STATS = Stats()
+
+
 def to_wei_hex(eth: float) -> str:
     return hex(int(eth * 10**18))
 
 
+# Constant for the process lifetime; computed once instead of per tx
+_VALUE_HEX = to_wei_hex(VALUE_ETH)
+_GAS_HEX = hex(21000)
+
+
 class Rpc:
-    def __init__(self, url: str, timeout: float = 10):
-        self.c = httpx.AsyncClient(timeout=timeout)
+    def __init__(self, url: str, timeout: float = 10, max_connections: int = 100):
+        self.timeout = timeout
+        self.max_connections = max_connections
+        self.c = self._client(max_connections)
+        # clients replaced by resize(), closed once their in-flight requests are done
+        self._retired = set()
+        self._closers = set()
         self.url = url
-        self._id = 0
-        self._rpc_counter = 0
-        self._lock = asyncio.Lock()
+        self._headers = {"Content-Type": "application/json"}
+        # ids are sequential, so the last one issued doubles as the sent-request count;
+        # no lock needed: nothing awaits between taking an id and using it
+        self._ids = itertools.count(1)
+        self._sent = 0
+        self._drained = 0
+
+    def _client(self, max_connections: int) -> httpx.AsyncClient:
+        # keep-alive pool sized to the worker count; http2 multiplexes when the endpoint speaks it
+        return httpx.AsyncClient(
+            timeout=self.timeout,
+            http2=True,
+            limits=httpx.Limits(
+                max_keepalive_connections=max_connections, max_connections=max_connections * 2
+            ),
+        )
+
+    def resize(self, max_connections: int):
+        """Swap in a client whose pool fits a new worker count (CONCURRENCY hot reload)."""
+        if max_connections == self.max_connections:
+            return
+        old, self.c = self.c, self._client(max_connections)
+        self.max_connections = max_connections
+        self._retired.add(old)
+        task = asyncio.create_task(self._close_later(old))
+        self._closers.add(task)
+        task.add_done_callback(self._closers.discard)
+
+    async def _close_later(self, client: httpx.AsyncClient):
+        # timeout applies per phase (pool, connect, write, read): after all four have
+        # elapsed, every request started on the old client has finished or failed
+        await asyncio.sleep(4 * self.timeout)
+        self._retired.discard(client)
+        await client.aclose()
 
     async def call(self, method: str, params):
-        async with self._lock:
-            self._id += 1
-            rid = self._id
+        rid = self._sent = next(self._ids)
         payload = {"jsonrpc": "2.0", "method": method, "params": params, "id": rid}
-        RPC_REQ.labels(method).inc()
-        self._rpc_counter += 1
+        _REQ[method].inc()
         start = time.perf_counter()
         try:
-            r = await self.c.post(self.url, json=payload)
+            r = await self.c.post(self.url, content=orjson.dumps(payload), headers=self._headers)
             latency = time.perf_counter() - start
-            RPC_LAT.labels(method).observe(latency)
+            _LAT[method].observe(latency)
             r.raise_for_status()
-            data = r.json()
+            data = orjson.loads(r.content)
             if "error" in data:
                 # expose RPC-level errors via exception so callers can count failures
                 raise RuntimeError(data["error"])
             return data["result"]
         except Exception:
             # ensure we still record latency on errors
-            RPC_LAT.labels(method).observe(time.perf_counter() - start)
+            _LAT[method].observe(time.perf_counter() - start)
             raise
 
+    async def call_batch(self, calls):
+        """Send [(method, params), ...] as one JSON-RPC batch; results come back in call order."""
+        if not calls:
+            return []
+        payload = [
+            {"jsonrpc": "2.0", "method": m, "params": p, "id": next(self._ids)} for m, p in calls
+        ]
+        for m, _ in calls:
+            _REQ[m].inc()
+        self._sent = payload[-1]["id"]
+        start = time.perf_counter()
+        try:
+            r = await self.c.post(self.url, content=orjson.dumps(payload), headers=self._headers)
+            r.raise_for_status()
+            data = orjson.loads(r.content)
+        finally:
+            latency = time.perf_counter() - start
+            for m, _ in calls:
+                _LAT[m].observe(latency)
+        if not isinstance(data, list):
+            # the server rejected the batch as a whole (e.g. too large) with one error object
+            raise RuntimeError(data.get("error", data) if isinstance(data, dict) else data)
+        by_id = {d.get("id"): d for d in data if isinstance(d, dict)}
+        results = []
+        for req in payload:
+            d = by_id.get(req["id"], {"error": "missing response"})
+            if "error" in d:
+                raise RuntimeError(d["error"])
+            results.append(d["result"])
+        return results
+
     def drain_rpc_counter(self):
-        v = self._rpc_counter
-        self._rpc_counter = 0
+        v = self._sent - self._drained
+        self._drained = self._sent
         return v
 
     async def close(self):
-        await self.c.aclose()
+        for task in self._closers:
+            task.cancel()
+        for client in [self.c, *self._retired]:
+            await client.aclose()
 
 
 async def get_sender(rpc: Rpc) -> str:
@@ -96,61 +228,111 @@ async def get_sender(rpc: Rpc) -> str:
     return accs[0]
 
 
-async def send_tx(rpc: Rpc, sender: str, to_addr: str, value_eth: float):
+def tx_fee_fields(priority: int) -> dict:
+    # EIP-1559 fees
+    return {
+        "maxPriorityFeePerGas": hex(priority),
+        "maxFeePerGas": hex(priority * 2),  # simple cap
+        # legacy alternative:
+        # "gasPrice": hex(1_000_000_000),
+    }
+
+
+# (fee fields, expires_at); starts at the 1 gwei floor, already expired
+_fee_cache = (tx_fee_fields(1_000_000_000), 0.0)
+
+
+async def tx_fees(rpc: Rpc) -> dict:
+    """Fee fields from eth_maxPriorityFeePerGas, refreshed at most once per TIP_TTL."""
+    global _fee_cache
+    fees, expires_at = _fee_cache
+    now = time.monotonic()
+    if now < expires_at:
+        return fees
+    # other senders keep using the stale value while this one refreshes
+    _fee_cache = (fees, now + TIP_TTL)
+    tip = await rpc.call("eth_maxPriorityFeePerGas", [])
+    tip_wei = int(tip, 16) if isinstance(tip, str) else int(tip)
+    fees = tx_fee_fields(max(tip_wei, 1_000_000_000))  # >= 1 gwei
+    _fee_cache = (fees, now + TIP_TTL)
+    return fees
+
+
+def tx_template(sender: str) -> dict:
+    """The per-process constant part of every eth_sendTransaction."""
+    return {"from": sender, "to": TO_ADDR, "value": _VALUE_HEX, "gas": _GAS_HEX}
+
+
+async def send_tx(rpc: Rpc, template: dict):
     TX_SENT.inc()
     try:
-        # EIP-1559 fees
-        tip = await rpc.call("eth_maxPriorityFeePerGas", [])
-        tip_wei = int(tip, 16) if isinstance(tip, str) else int(tip)
-        priority = max(tip_wei, 1_000_000_000)  # >= 1 gwei
-        maxfee = priority * 2  # simple cap
-
-        params = [
-            {
-                "from": sender,
-                "to": to_addr,
-                "value": to_wei_hex(value_eth),
-                "gas": hex(21000),
-                "maxPriorityFeePerGas": hex(priority),
-                "maxFeePerGas": hex(maxfee),
-                # legacy alternative:
-                # "gasPrice": hex(1_000_000_000),
-            }
-        ]
-        _ = await rpc.call("eth_sendTransaction", params)
+        tx = template.copy()
+        tx.update(await tx_fees(rpc))
+        _ = await rpc.call("eth_sendTransaction", [tx])
         TX_OK.inc()
+        STATS.ok += 1
     except Exception as e:
         TX_ERR.inc()
+        STATS.err += 1
         print(f"[loadgen] eth_sendTransaction error: {e}", flush=True)
         raise
 
 
-async def rate_limiter(tps: float):
-    interval = 1.0 / tps if tps > 0 else 0.0
-    next_t = time.perf_counter()
+# queued after the outstanding tokens to retire a worker once they are sent
+_RETIRE = object()
+
+
+async def tx_worker(rpc: Rpc, q: asyncio.Queue, template: dict):
+    """Long-lived sender: one tx per token pulled from the queue."""
+    while True:
+        if await q.get() is _RETIRE:
+            return
+        try:
+            await send_tx(rpc, template)
+        except Exception:
+            pass
+
+
+async def rate_limiter(tps: float, q: asyncio.Queue, min_tick: float = 0.005):
+    """
+    Token bucket feeding the tx workers: each wake-up queues every tx due since
+    the last release. Sleeps until the next token, but never for less than
+    min_tick, so high TPS is released in batches instead of one sub-millisecond
+    sleep per tx. A full queue blocks the put (backpressure); tokens that came due
+    while a put was blocked are banked only up to one queue's worth, so a stall
+    isn't followed by a burst above TPS. The tokens due during the sleep itself
+    are always released. TPS <= 0 releases nothing.
+    """
+    if tps <= 0:
+        await asyncio.Event().wait()
+    interval = 1.0 / tps
+    backlog = q.maxsize or 1
+    last = time.perf_counter()
     while True:
+        slept_at = time.perf_counter()
+        await asyncio.sleep(max(last + interval - slept_at, min_tick))
         now = time.perf_counter()
-        if now < next_t:
-            await asyncio.sleep(next_t - now)
-        yield
-        next_t += interval
+        n = int((now - last) / interval)
+        # this tick's own batch (including a late wake-up) plus the capped backlog
+        cap = backlog + math.ceil((now - slept_at) / interval)
+        if n > cap:
+            n, last = cap, now
+        else:
+            last += n * interval
+        for _ in range(n):
+            await q.put(None)
 
 
 async def sampler(rpc: Rpc, window: float):
-    last_ok = TX_OK._value.get()
-    last_err = TX_ERR._value.get()
-
-    # prime with the current head
-    head = await rpc.call("eth_getBlockByNumber", ["latest", False])
-    last_num = int(head["number"], 16)
-    last_mgas = 0.0
+    last_ok = STATS.ok
+    last_err = STATS.err
 
     while True:
         await asyncio.sleep(window)
 
         # 1) Achieved TPS & failure rate over the window
-        ok = TX_OK._value.get()
-        err = TX_ERR._value.get()
+        ok = STATS.ok
+        err = STATS.err
         okd = ok - last_ok
         errd = err - last_err
         total = okd + errd
@@ -161,23 +343,43 @@ async def sampler(rpc: Rpc, window: float):
         # 2) RPS from internal counter
         RPS.set(rpc.drain_rpc_counter() / window)
 
-        # 3) MGas/s from new head block (gasUsed / block_time)
-        blk = await rpc.call("eth_getBlockByNumber", ["latest", False])
-        num = int(blk["number"], 16)
-
-        if num > last_num:
-            # fetch parent to get its timestamp
-            parent = await rpc.call("eth_getBlockByHash", [blk["parentHash"], False])
-            ts = int(blk["timestamp"], 16)
-            pts = int(parent["timestamp"], 16)
-            dt = max(ts - pts, 1)  # seconds
-            gas = int(blk["gasUsed"], 16)  # gas in this block
-            last_mgas = (gas / dt) / 1_000_000  # MGas/s for this block
-            MGAS_S.set(last_mgas)
-            last_num = num
-        else:
-            # no new block yet; keep the previous per-block MGas/s
-            MGAS_S.set(last_mgas)
+
+async def head_watcher(rpc: Rpc, ws_url: str):
+    """
+    MGas/s per block (gasUsed / block_time) from an eth_subscribe newHeads stream.
+    The header carries timestamp and gasUsed, and the parent's timestamp is the
+    previous header's, so a block only costs an RPC when its parent wasn't seen
+    (first head after a (re)connect).
+    """
+    sub = orjson.dumps(
+        {"jsonrpc": "2.0", "id": 1, "method": "eth_subscribe", "params": ["newHeads"]}
+    )
+    while True:
+        prev = None  # (hash, timestamp) of the last header seen
+        try:
+            async with websockets.connect(ws_url, max_size=None) as ws:
+                await ws.send(sub)
+                async for msg in ws:
+                    data = orjson.loads(msg)
+                    if data.get("method") != "eth_subscription":
+                        if "error" in data:
+                            raise RuntimeError(data["error"])
+                        continue
+                    head = data["params"]["result"]
+                    ts = int(head["timestamp"], 16)
+                    if prev is not None and prev[0] == head["parentHash"]:
+                        pts = prev[1]
+                    else:
+                        parent = await rpc.call("eth_getBlockByHash", [head["parentHash"], False])
+                        pts = int(parent["timestamp"], 16)
+                    dt = max(ts - pts, 1)  # seconds
+                    gas = int(head["gasUsed"], 16)  # gas in this block
+                    MGAS_S.set((gas / dt) / 1_000_000)  # MGas/s for this block
+                    prev = (head["hash"], ts)
+        except Exception as e:
+            print(f"[loadgen] newHeads subscription error: {e}", flush=True)
+        # reconnect after a short pause, whether the stream failed or just closed
+        await asyncio.sleep(2)
 
 
 async def rps_loop(rpc: Rpc, method: str, params_fn, rps: float):
@@ -198,57 +400,172 @@ async def rps_loop(rpc: Rpc, method: str, params_fn, rps: float):
         next_t += interval
 
 
+class TxPipeline:
+    """The rate limiter plus its worker pool, re-tuned in place on config changes."""
+
+    def __init__(self, rpc: Rpc, template: dict):
+        self.rpc = rpc
+        self.template = template
+        self.q = None
+        self.workers = []
+        # retired pools draining their queues, and the tasks retiring them; held here so
+        # they can't be garbage-collected mid-drain and so close() can cancel them
+        self.draining = set()
+        self.limiter = None
+        self.tps = None
+        self.concurrency = None
+
+    def apply(self, tps: float, concurrency: int):
+        if concurrency != self.concurrency:
+            # new pool and queue; the old workers finish what is already queued
+            self._stop_limiter()
+            if self.q is not None:
+                self._track(asyncio.create_task(self._retire(self.q, len(self.workers))))
+                for w in self.workers:
+                    self._track(w)
+            self.rpc.resize(concurrency)
+            self.q = asyncio.Queue(maxsize=concurrency * 2)
+            self.workers = [
+                asyncio.create_task(tx_worker(self.rpc, self.q, self.template))
+                for _ in range(concurrency)
+            ]
+            self.concurrency = concurrency
+        if tps != self.tps or self.limiter is None:
+            self._stop_limiter()
+            self.limiter = asyncio.create_task(rate_limiter(tps, self.q))
+            self.tps = tps
+
+    def _stop_limiter(self):
+        if self.limiter is not None:
+            self.limiter.cancel()
+            self.limiter = None
+
+    def _track(self, task: asyncio.Task):
+        self.draining.add(task)
+        task.add_done_callback(self.draining.discard)
+
+    @staticmethod
+    async def _retire(q: asyncio.Queue, n: int):
+        for _ in range(n):
+            await q.put(_RETIRE)
+
+    def close(self):
+        self._stop_limiter()
+        for w in [*self.workers, *self.draining]:
+            w.cancel()
+
+
+class ReadLoops:
+    """One rps_loop per read method, restarted only when its rate changes."""
+
+    def __init__(self, rpc: Rpc, sender: str):
+        self.rpc = rpc
+        self.params = {
+            "eth_blockNumber": lambda: [],
+            "eth_getBalance": lambda: [sender, "latest"],
+            "eth_call": lambda: [{"to": TO_ADDR}, "latest"],
+        }
+        self.rates = {}
+        self.tasks = {}
+
+    def apply(self, rates: dict):
+        for method, rps in rates.items():
+            if self.rates.get(method) == rps:
+                continue
+            task = self.tasks.pop(method, None)
+            if task is not None:
+                task.cancel()
+            if rps > 0:
+                self.tasks[method] = asyncio.create_task(
+                    rps_loop(self.rpc, method, self.params[method], rps)
+                )
+            self.rates[method] = rps
+
+    def close(self):
+        for task in self.tasks.values():
+            task.cancel()
+
+
+def load_tuning() -> dict:
+    """Env defaults, overridden by any readable TUNABLES file in CONFIG_DIR."""
+    tuning = {
+        "TPS": TPS,
+        "CONCURRENCY": CONCURRENCY,
+        "RPS_BLOCK": RPS_BLOCK,
+        "RPS_BAL": RPS_BAL,
+        "RPS_CALL": RPS_CALL,
+    }
+    for name, cast in TUNABLES.items():
+        path = os.path.join(CONFIG_DIR, name)
+        try:
+            with open(path) as f:
+                tuning[name] = cast(float(f.read().strip()))
+        except FileNotFoundError:
+            pass
+        except (OSError, ValueError) as e:
+            print(f"[loadgen] ignoring {path}: {e}", flush=True)
+    tuning["CONCURRENCY"] = max(tuning["CONCURRENCY"], 1)
+    return tuning
+
+
+async def watch_config(apply, last: dict):
+    """Re-apply tuning whenever the mounted ConfigMap changes (kubelet swaps it atomically).
+
+    `last` is the tuning already applied. The files are also re-read on every
+    timeout yield, so a swap that lands before the watcher is ready is still seen.
+    """
+    if not os.path.isdir(CONFIG_DIR):
+        print(f"[loadgen] {CONFIG_DIR} not mounted; tuning fixed to env", flush=True)
+        await asyncio.Event().wait()
+    async for _ in watchfiles.awatch(CONFIG_DIR, yield_on_timeout=True, rust_timeout=5000):
+        tuning = load_tuning()
+        if tuning != last:
+            apply(tuning)
+            last = tuning
+
+
 async def run():
     start_http_server(9100)
-    rpc = Rpc(RPC_URL, timeout=10)
+    tuning = load_tuning()
+    rpc = Rpc(RPC_URL, timeout=10, max_connections=tuning["CONCURRENCY"])
+    pipeline = reads = None
     try:
         sender = await get_sender(rpc)
 
-        # Warm up labelled series so short-window rates aren't empty
-        for m in [
-            "eth_sendTransaction",
-            "eth_maxPriorityFeePerGas",
-            "eth_blockNumber",
-            "eth_getBalance",
-            "eth_call",
-        ]:
-            RPC_REQ.labels(m)
-            RPC_LAT.labels(m)
-
-        # TX path
-        sem = asyncio.Semaphore(CONCURRENCY)
-        limiter = rate_limiter(TPS)
-
-        async def one():
-            async with sem:
-                try:
-                    await send_tx(rpc, sender, TO_ADDR, VALUE_ETH)
-                except Exception:
-                    pass
-
-        # Sampler
-        asyncio.create_task(sampler(rpc, SAMPLE_WINDOW))
-
-        # Read-method RPS loops (driven by env vars)
-        if RPS_BLOCK > 0:
-            asyncio.create_task(rps_loop(rpc, "eth_blockNumber", lambda: [], RPS_BLOCK))
-        if RPS_BAL > 0:
-            asyncio.create_task(
-                rps_loop(rpc, "eth_getBalance", lambda: [sender, "latest"], RPS_BAL)
-            )
-        if RPS_CALL > 0:
-            asyncio.create_task(
-                rps_loop(rpc, "eth_call", lambda: [{"to": TO_ADDR}, "latest"], RPS_CALL)
+        # TX path: CONCURRENCY workers fed by a bounded queue; a full queue
+        # blocks the limiter, which caps in-flight txs without per-tx Tasks
+        pipeline = TxPipeline(rpc, tx_template(sender))
+        # Read-method RPS loops
+        reads = ReadLoops(rpc, sender)
+
+        def apply(t: dict):
+            print(f"[loadgen] tuning: {t}", flush=True)
+            pipeline.apply(t["TPS"], t["CONCURRENCY"])
+            reads.apply(
+                {
+                    "eth_blockNumber": t["RPS_BLOCK"],
+                    "eth_getBalance": t["RPS_BAL"],
+                    "eth_call": t["RPS_CALL"],
+                }
             )
 
-        # Fire the TX generator
-        async for _ in limiter:
-            asyncio.create_task(one())
+        apply(tuning)
+
+        # Sampler + per-block MGas/s
+        asyncio.create_task(sampler(rpc, SAMPLE_WINDOW))
+        asyncio.create_task(head_watcher(rpc, WS_URL))
+
+        # Hot-reload tuning for the life of the process
+        await watch_config(apply, tuning)
 
     finally:
+        if pipeline is not None:
+            pipeline.close()
+        if reads is not None:
+            reads.close()
         with contextlib.suppress(Exception):
             await rpc.close()
 
 
 if __name__ == "__main__":
-    asyncio.run(run())
+    uvloop.run(run())